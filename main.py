@@ -2,18 +2,26 @@ import os
 import sys
 import re
 import io
+import hashlib
+import sqlite3
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib
 
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import seaborn as sns
+import numpy as np
 import pandas as pd
 from telebot import TeleBot, types
 from googleapiclient.discovery import build
+from googleapiclient.http import build_http
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 from deep_translator import GoogleTranslator
 from dotenv import load_dotenv
-from urllib.parse import urlparse, parse_qs
+from cachetools import TTLCache, cached
 
 # --- НАЛАШТУВАННЯ ---
 load_dotenv()
@@ -24,67 +32,205 @@ if not YT_API_KEY or not TG_BOT_TOKEN:
     print("Помилка: Перевірте файл .env (потрібні YOUTUBE_API_KEY та TELEGRAM_BOT_TOKEN)")
     sys.exit()
 
-bot = TeleBot(TG_BOT_TOKEN)
+# Обробники виконуються в пулі з 8 потоків, щоб довгий аналіз не блокував інших користувачів
+bot = TeleBot(TG_BOT_TOKEN, num_threads=8)
+# Пул для важкої роботи всередині обробника (YouTube + аналіз, графіки)
+executor = ThreadPoolExecutor(max_workers=8)
+# Спільний пул для запитів до Google Translate: загальне обмеження паралельних запитів
+# для всіх користувачів, щоб не отримувати TooManyRequests
+translate_pool = ThreadPoolExecutor(max_workers=16)
 analyzer = SentimentIntensityAnalyzer()
-translator = GoogleTranslator(source='auto', target='en')
+_local = threading.local()
+# Стиль графіків задається один раз, а не в кожному потоці
+sns.set_style("whitegrid")
+
+# VADER має квадратичне уповільнення на текстах з великою кількістю емодзі
+EMOJI_RE = re.compile(r'[\U0001F300-\U0001FAFF\u2600-\u27BF]')
+MAX_EMOJIS = 50
+# Лише слова, яких немає в інших поширених мовах (a, to, in, is трапляються в іспанській, польській тощо)
+ENGLISH_STOPWORDS = frozenset({
+    'the', 'and', 'of', 'this', 'that', 'with', 'you', 'are', 'have', 'it', 'but', 'not', 'what', 'just',
+    'your', 'they'
+})
+MIN_STOPWORD_HITS = 2
+_WORD_RE = re.compile(r"[a-z']+")
+_CLEAN_RE = re.compile(r'(?<=\b\w)\s+(?=\w\b)')
+# ID відео з youtu.be, /watch?v=, /shorts/, /embed/, /v/ або сам ID з 11 символів
+# Хост без урахування регістру і лише на межі (початок, // або .), щоб не ловити notyoutube.com
+_YT_ID_RE = re.compile(
+    r'(?:(?:^|//|\.)(?:youtu\.be/|youtube\.com/(?:watch\?(?:[^&#]*&)*v=|shorts/|embed/|v/))'
+    r'|^(?=[A-Za-z0-9_-]{11}$))'
+    r'([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])',
+    re.IGNORECASE
+)
+
+# Один клієнт YouTube на весь процес; httplib2 не потокобезпечний, тому кожен потік
+# виконує запити через власний http-об'єкт (get_http)
+YOUTUBE = build('youtube', 'v3', developerKey=YT_API_KEY, cache_discovery=False, static_discovery=True)
+# Кожна сторінка коментарів коштує одиницю квоти, тому обмежуємо загальну кількість
+MAX_COMMENTS = 500
+
+# Кеш перекладів на диску: повторні коментарі не перекладаються і не оцінюються заново
+# Версію треба збільшувати при кожній зміні перекладу чи оцінювання: старі записи тоді видаляються
+PIPELINE_VERSION = 2
+cache = sqlite3.connect('trans_cache.db', check_same_thread=False)
+cache.execute(
+    "CREATE TABLE IF NOT EXISTS cache (hash TEXT PRIMARY KEY, translated TEXT, score REAL, category TEXT)"
+)
+if cache.execute("PRAGMA user_version").fetchone()[0] != PIPELINE_VERSION:
+    cache.execute("DELETE FROM cache")
+    cache.execute(f"PRAGMA user_version = {PIPELINE_VERSION}")
+    cache.commit()
+cache_lock = threading.Lock()
 
 
 # --- ЛОГІКА АНАЛІЗУ (Збережена з минулого разу) ---
 
 def extract_video_id(url):
-    if len(url) == 11 and ' ' not in url and '/' not in url: return url
-    query = urlparse(url)
-    if query.hostname == 'youtu.be': return query.path[1:]
-    if query.hostname in ('www.youtube.com', 'youtube.com', 'm.youtube.com'):
-        if query.path == '/watch': return parse_qs(query.query)['v'][0]
-        if query.path[:8] == '/shorts/': return query.path.split('/')[2]
-    return None
+    m = _YT_ID_RE.search(url)
+    return m.group(1) if m else None
 
 
 def clean_text(text):
-    return re.sub(r'(?<=\b\w)\s+(?=\w\b)', '', text)
+    return _CLEAN_RE.sub('', text)
 
 
-def analyze_comment(text):
+def get_translator():
+    # Окремий GoogleTranslator на кожен потік, щоб потоки не ділили одну сесію
+    if not hasattr(_local, 'translator'):
+        _local.translator = GoogleTranslator(source='auto', target='en')
+    return _local.translator
+
+
+def get_http():
+    if not hasattr(_local, 'http'):
+        _local.http = build_http()
+    return _local.http
+
+
+def translate_one(text):
     try:
-        translated = translator.translate(text)
+        return get_translator().translate(text)
     except:
-        translated = text
-    if not translated: translated = text
+        return None
+
+
+def looks_english(text):
+    # Дешева евристика: майже весь текст ASCII і є щонайменше два різні англійські службові слова
+    ascii_ratio = sum(c < '\x80' for c in text) / max(len(text), 1)
+    if ascii_ratio <= 0.9: return False
+    return len(ENGLISH_STOPWORDS.intersection(_WORD_RE.findall(text.lower()))) >= MIN_STOPWORD_HITS
+
+
+def translate_texts(texts):
+    # Кожен коментар перекладається окремим запитом, запити йдуть паралельно;
+    # помилка одного коментаря не зачіпає решту, порядок зберігає ex.map
+    if not texts: return []
+    return list(translate_pool.map(translate_one, texts))
+
 
+@functools.lru_cache(maxsize=4096)
+def _score(text):
+    # Короткі однакові коментарі ("First!", "lol") трапляються дуже часто
+    return analyzer.polarity_scores(text)['compound']
+
+
+def score_text(translated):
     final_text = clean_text(translated)
-    scores = analyzer.polarity_scores(final_text)
-    compound = scores['compound']
+    if len(EMOJI_RE.findall(final_text)) > MAX_EMOJIS:
+        final_text = EMOJI_RE.sub('', final_text)
+    return _score(final_text), final_text
+
+
+def categorize(scores):
+    # Категорії для всіх оцінок одним векторним проходом
+    scores = np.asarray(scores, dtype=float)
+    return np.select([scores >= 0.05, scores <= -0.05], ['Positive', 'Negative'], default='Neutral')
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def cache_lookup(hashes):
+    # Один запит на всі хеші; їх не більше MAX_COMMENTS, тож ліміт параметрів SQLite не перевищується
+    hashes = list(hashes)
+    if not hashes: return {}
+    placeholders = ', '.join('?' * len(hashes))
+    with cache_lock:
+        rows = cache.execute(
+            f"SELECT hash, translated, score, category FROM cache WHERE hash IN ({placeholders})", hashes
+        ).fetchall()
+    return {h: (translated, score, category) for h, translated, score, category in rows}
 
-    if compound >= 0.05:
-        category = 'Positive'
-    elif compound <= -0.05:
-        category = 'Negative'
-    else:
-        category = 'Neutral'
-    return compound, category, final_text
+
+def cache_store(rows):
+    if not rows: return
+    with cache_lock:
+        cache.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", rows)
+        cache.commit()
+
+
+def analyze_texts(texts):
+    """Повертає (translated, score, category) для кожного тексту, використовуючи кеш"""
+    # Однакові коментарі перекладаємо й оцінюємо один раз
+    hashes = {t: text_hash(t) for t in dict.fromkeys(texts)}
+    results = cache_lookup(hashes.values())
+
+    missing = [(h, t) for t, h in hashes.items() if h not in results]
+
+    # Англійські коментарі VADER оцінює напряму, перекладаємо лише решту
+    english = [looks_english(t) for _, t in missing]
+    translated_iter = iter(translate_texts([t for (_, t), en in zip(missing, english) if not en]))
+    translated_list = [t if en else next(translated_iter) for (_, t), en in zip(missing, english)]
+
+    scored = [score_text(translated or text) for (_, text), translated in zip(missing, translated_list)]
+    categories = categorize([score for score, _ in scored])
+
+    new_rows = []
+    for (h, _), translated, (score, final_text), category in zip(missing, translated_list, scored, categories):
+        category = str(category)
+        results[h] = (final_text, score, category)
+        # Невдалий переклад не кешуємо, щоб наступного разу спробувати знову
+        if translated: new_rows.append((h, final_text, score, category))
+    cache_store(new_rows)
+
+    return [results[hashes[t]] for t in texts]
+
+
+@cached(TTLCache(maxsize=512, ttl=3600), lock=threading.Lock())
+def fetch_comments(video_id, max_results):
+    # Відповідь кешується на годину: повторний аналіз того ж відео не витрачає квоту API
+    # API віддає не більше 100 коментарів за сторінку, тому йдемо по nextPageToken
+    target = min(max_results, MAX_COMMENTS)
+    items = []
+    request = YOUTUBE.commentThreads().list(
+        part="snippet", videoId=video_id, maxResults=min(target, 100), textFormat="plainText"
+    )
+    while request is not None and len(items) < target:
+        response = request.execute(http=get_http())
+        items.extend(response['items'])
+        request = YOUTUBE.commentThreads().list_next(request, response)
+    return items[:target]
 
 
 def get_data(video_id, max_results=30):
     # max_results менше, щоб бот відповідав швидше
     try:
-        youtube = build('youtube', 'v3', developerKey=YT_API_KEY)
-        request = youtube.commentThreads().list(
-            part="snippet", videoId=video_id, maxResults=max_results, textFormat="plainText"
-        )
-        response = request.execute()
-
-        data = []
-        for item in response['items']:
-            snippet = item['snippet']['topLevelComment']['snippet']
-            score, category, trans = analyze_comment(snippet['textDisplay'])
-            data.append({
-                'Author': snippet['authorDisplayName'],
-                'Original': snippet['textDisplay'],
-                'Score': score,
-                'Category': category
-            })
-        return pd.DataFrame(data)
+        items = fetch_comments(video_id, max_results)
+
+        snippets = [item['snippet']['topLevelComment']['snippet'] for item in items]
+        texts = [snippet['textDisplay'] for snippet in snippets]
+        results = analyze_texts(texts)
+
+        return pd.DataFrame({
+            'Author': [snippet['authorDisplayName'] for snippet in snippets],
+            'Original': texts,
+            'Score': [score for _, score, _ in results],
+            'Category': pd.Categorical(
+                [category for _, _, category in results], categories=['Positive', 'Neutral', 'Negative']
+            )
+        })
     except Exception as e:
         print(f"API Error: {e}")
         return None
@@ -92,12 +238,12 @@ def get_data(video_id, max_results=30):
 
 # --- ФУНКЦІЇ ДЛЯ БОТА ---
 
-def generate_report_text(df):
+def generate_report_text(df, counts):
     """Генерує текстове повідомлення зі статистикою"""
     avg_score = df['Score'].mean()
     total = len(df)
-    pos = len(df[df['Category'] == 'Positive'])
-    neg = len(df[df['Category'] == 'Negative'])
+    pos = int(counts.get('Positive', 0))
+    neg = int(counts.get('Negative', 0))
 
     if avg_score > 0.1:
         verdict = "👍 Позитивний"
@@ -117,31 +263,34 @@ def generate_report_text(df):
     return text
 
 
-def generate_charts(df):
+def generate_charts(df, counts):
     """Малює графіки і повертає їх як байтовий об'єкт (картинку в пам'яті)"""
-    sns.set_style("whitegrid")
-    fig, axes = plt.subplots(1, 2, figsize=(12, 6))
+    # Figure без pyplot: немає глобального стану, безпечно з кількох потоків
+    # Telegram все одно стискає фото, тому менший розмір і DPI лише економлять час рендеру
+    fig = Figure(figsize=(8, 4), dpi=90)
+    canvas = FigureCanvasAgg(fig)
+    axes = fig.subplots(1, 2)
 
 
-    counts = df['Category'].value_counts()
     colors = {'Positive': '#66bb6a', 'Neutral': '#fff176', 'Negative': '#ef5350'}
+    # Категоріальний стовпець рахує і порожні категорії, на діаграмі вони не потрібні
+    counts = counts[counts > 0]
     pie_colors = [colors.get(k, '#bdbdbd') for k in counts.index]
     if len(counts) > 0:
         axes[0].pie(counts, labels=counts.index, autopct='%1.1f%%', colors=pie_colors)
     axes[0].set_title('Емоції')
 
     # Histogram
-    sns.histplot(df['Score'], bins=15, kde=True, ax=axes[1], color='#5c6bc0')
+    sns.histplot(df['Score'], bins=15, kde=False, ax=axes[1], color='#5c6bc0')
     axes[1].set_title('Розподіл')
     axes[1].axvline(0, color='black', linestyle='--')
 
-    plt.tight_layout()
+    fig.tight_layout()
 
 
     buf = io.BytesIO()
-    plt.savefig(buf, format='png')
+    canvas.print_png(buf, metadata={'Software': None}, pil_kwargs={'optimize': True})
     buf.seek(0)
-    plt.close()
     return buf
 
 
@@ -161,29 +310,37 @@ def handle_message(message):
         bot.reply_to(message, "Це не схоже на посилання YouTube. Спробуй ще раз.")
         return
 
+    # Завантаження коментарів стартує одночасно з відправкою статусу
+    data_future = executor.submit(get_data, video_id, max_results=40)
+
     # Відправляємо повідомлення
     status_msg = bot.reply_to(message, "⏳ Аналізую коментарі... Це займе хвилину.")
 
     # Отримуємо дані
-    df = get_data(video_id, max_results=40)
+    df = data_future.result()
 
     if df is not None and not df.empty:
+        # Підрахунок категорій один раз для звіту і графіків
+        counts = df['Category'].value_counts()
+
+        # Графіки малюються у фоні, поки відправляється текстовий звіт і готується CSV
+        charts_future = executor.submit(generate_charts, df, counts)
+
         # 1. Текстовий звіт
-        report = generate_report_text(df)
+        report = generate_report_text(df, counts)
         bot.send_message(message.chat.id, report, parse_mode='HTML')
 
+        # CSV готуємо, поки малюються графіки
+        csv_bytes = io.BytesIO()
+        df.to_csv(csv_bytes, index=False, encoding='utf-8')
+        csv_bytes.seek(0)
+        csv_bytes.name = f"report_{video_id}.csv"
+
         # 2. Графіки
-        photo = generate_charts(df)
+        photo = charts_future.result()
         bot.send_photo(message.chat.id, photo)
 
         # 3. CSV файл
-        csv_buffer = io.StringIO()
-        df.to_csv(csv_buffer, index=False)
-        csv_buffer.seek(0)
-
-        csv_bytes = io.BytesIO(csv_buffer.getvalue().encode())
-        csv_bytes.name = f"report_{video_id}.csv"
-
         bot.send_document(message.chat.id, csv_bytes, caption="📂 Детальна таблиця")
 
 
@@ -197,4 +354,5 @@ def handle_message(message):
 # --- ЗАПУСК ---
 if __name__ == "__main__":
     print("🤖 Бот запущено...")
-    bot.polling(none_stop=True)
\ No newline at end of file
+    # Long polling: Telegram тримає з'єднання до 50 с замість постійних порожніх запитів
+    bot.infinity_polling(timeout=60, long_polling_timeout=50, skip_pending=True)
\ No newline at end of file